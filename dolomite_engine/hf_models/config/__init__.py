@@ -28,6 +28,11 @@ def _hold_base_args(key: str) -> Callable:
     return _holded_function
 
 
+def _get_block_value_getter(blocks: list[dict | BaseArgs]) -> Callable:
+    # blocks are either all dicts or all BaseArgs, so the getter is picked once for the whole list
+    return dict.get if isinstance(blocks[0], dict) else getattr
+
+
 def _update_with_key_value(block: dict, kwargs: dict, key: str) -> None:
     if key in block:
         kwargs[key] = block.pop(key)
@@ -154,19 +159,37 @@ class CommonConfig(PretrainedConfig):
         return super().to_json_string(use_diff)
 
     def check_equal_for_all_and_get_value(self, key: str, key_block: str, expected_value: Any | None = None) -> Any:
-        def _get(block, key):
-            return block.get(key) if isinstance(block, dict) else getattr(block, key)
-
         blocks = getattr(self, key)
-        value = _get(blocks[0], key_block)
+        get_block_value = _get_block_value_getter(blocks)
+        value = get_block_value(blocks[0], key_block)
 
         if expected_value is not None:
             assert value == expected_value, f"{value} {expected_value}"
 
-        assert all([_get(block, key_block) == value for block in blocks])
+        assert all([get_block_value(block, key_block) == value for block in blocks])
 
         return value
 
+    def check_equal_for_all_and_get_values(
+        self, key: str, key_blocks: list[str], expected_values: dict[str, Any] | None = None
+    ) -> dict[str, Any]:
+        if expected_values is None:
+            expected_values = {}
+
+        blocks = getattr(self, key)
+        get_block_value = _get_block_value_getter(blocks)
+        values = {key_block: get_block_value(blocks[0], key_block) for key_block in [*key_blocks, *expected_values]}
+
+        for key_block, expected_value in expected_values.items():
+            assert values[key_block] == expected_value, f"{key_block}: {values[key_block]} != {expected_value}"
+
+        for block in blocks[1:]:
+            for key_block, value in values.items():
+                block_value = get_block_value(block, key_block)
+                assert block_value == value, f"{key_block}: {block_value} != {value}"
+
+        return values
+
     def _set_sequence_mixer_blocks(self) -> None:
         if self.sequence_mixer_blocks is None:
             self.sequence_mixer_blocks = [{} for _ in range(self.num_layers)]
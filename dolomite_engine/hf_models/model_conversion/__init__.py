@@ -1,3 +1,4 @@
+import torch
 from transformers import AutoConfig
 
 from .bigcode import export_to_huggingface_bigcode, import_from_huggingface_bigcode
@@ -35,10 +36,21 @@ _MODEL_EXPORT_FUNCTIONS = {
     "llama": export_to_huggingface_llama,
 }
 
+_MODEL_EXPORT_WITH_DTYPE_MODEL_TYPES = {"granitemoe", "granitemoeshared"}
 
-def export_to_huggingface(pretrained_model_name_or_path: str, save_path: str, model_type: str) -> None:
+
+def export_to_huggingface(
+    pretrained_model_name_or_path: str, save_path: str, model_type: str, dtype: torch.dtype | None = None
+) -> None:
     if model_type not in _MODEL_EXPORT_FUNCTIONS:
         raise NotImplementedError(f"the current model_type ({model_type}) is not yet supported")
 
     export_function = _MODEL_EXPORT_FUNCTIONS[model_type]
-    export_function(pretrained_model_name_or_path, save_path)
+
+    if dtype is None:
+        export_function(pretrained_model_name_or_path, save_path)
+    else:
+        if model_type not in _MODEL_EXPORT_WITH_DTYPE_MODEL_TYPES:
+            raise NotImplementedError(f"exporting with a dtype is not yet supported for model_type ({model_type})")
+
+        export_function(pretrained_model_name_or_path, save_path, dtype=dtype)
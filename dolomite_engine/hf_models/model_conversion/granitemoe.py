@@ -1,6 +1,7 @@
+import torch
 from transformers import AutoConfig, AutoTokenizer, GenerationConfig, GraniteMoeConfig, GraniteMoeForCausalLM
 
-from ...utils import SafeTensorsWeightsManager, download_repo
+from ...utils import SafeTensorsWeightsManager, SafeTensorsWeightsWriter, download_repo
 from ..models import GPTDolomiteConfig
 from .granitemoeshared import _export_state_dict_to_huggingface, _import_state_dict_from_huggingface
 
@@ -80,21 +81,29 @@ def _import_config_from_huggingface(original_config: GraniteMoeConfig) -> GPTDol
     return config
 
 
-def export_to_huggingface_granitemoe(pretrained_model_name_or_path: str, save_path: str) -> None:
+def export_to_huggingface_granitemoe(
+    pretrained_model_name_or_path: str, save_path: str, dtype: torch.dtype | None = None
+) -> None:
     config: GPTDolomiteConfig = AutoConfig.from_pretrained(pretrained_model_name_or_path)
     original_config = _export_config_to_huggingface(config)
-    num_attention_heads = config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "num_attention_heads")
 
-    safetensors_weights_manager = SafeTensorsWeightsManager(pretrained_model_name_or_path)
-    state_dict = _export_state_dict_to_huggingface(
-        safetensors_weights_manager,
-        config.num_layers,
-        num_attention_heads,
-        config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "num_key_value_heads"),
-        config.hidden_size // num_attention_heads,
-    )
+    if dtype is not None:
+        original_config.torch_dtype = dtype
+
+    with (
+        SafeTensorsWeightsManager(pretrained_model_name_or_path) as safetensors_weights_manager,
+        SafeTensorsWeightsWriter(save_path) as safetensors_weights_writer,
+    ):
+        _export_state_dict_to_huggingface(
+            safetensors_weights_manager,
+            safetensors_weights_writer,
+            config.num_layers,
+            original_config.num_attention_heads,
+            original_config.num_key_value_heads,
+            config.hidden_size // original_config.num_attention_heads,
+            dtype,
+        )
 
-    SafeTensorsWeightsManager.save_state_dict(state_dict, save_path)
     original_config.save_pretrained(save_path)
 
     original_generation_config = GenerationConfig.from_model_config(original_config)
@@ -111,19 +120,31 @@ def _export_config_to_huggingface(config: GPTDolomiteConfig) -> GraniteMoeConfig
     assert config.normalization_function == "rmsnorm"
     assert config.position_embedding_type == "rope"
 
-    config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "add_bias", False)
-    config.check_equal_for_all_and_get_value("mlp_blocks", "add_bias", False)
-    config.check_equal_for_all_and_get_value("mlp_blocks", "activation_function", "swiglu")
+    sequence_mixer_values = config.check_equal_for_all_and_get_values(
+        "sequence_mixer_blocks",
+        ["num_attention_heads", "num_key_value_heads", "softmax_dropout", "attention_multiplier"],
+        expected_values={"add_bias": False},
+    )
+
     config.check_equal_for_all_and_get_value("mlp_blocks", "mlp_type", "MoE")
+    mlp_values = config.check_equal_for_all_and_get_values(
+        "mlp_blocks",
+        ["intermediate_size", "num_experts", "num_experts_per_tok"],
+        expected_values={"add_bias": False, "activation_function": "swiglu"},
+    )
+
+    m_emb = config.m_emb
+    m_residual = config.m_residual
+    m_width = config.m_width
 
     original_config = GraniteMoeConfig(
         vocab_size=config.vocab_size,
         max_position_embeddings=config.max_position_embeddings,
         hidden_size=config.hidden_size,
         num_hidden_layers=config.num_layers,
-        num_attention_heads=config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "num_attention_heads"),
-        num_key_value_heads=config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "num_key_value_heads"),
-        intermediate_size=config.check_equal_for_all_and_get_value("mlp_blocks", "intermediate_size"),
+        num_attention_heads=sequence_mixer_values["num_attention_heads"],
+        num_key_value_heads=sequence_mixer_values["num_key_value_heads"],
+        intermediate_size=mlp_values["intermediate_size"],
         hidden_act="silu",
         rms_norm_eps=config.layer_norm_epsilon,
         use_cache=config.use_cache,
@@ -132,17 +153,17 @@ def _export_config_to_huggingface(config: GPTDolomiteConfig) -> GraniteMoeConfig
         initializer_range=config.initializer_range,
         rope_theta=config.rope_theta,
         rope_scaling=config.rope_scaling,
-        attention_dropout=config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "softmax_dropout"),
-        num_local_experts=config.check_equal_for_all_and_get_value("mlp_blocks", "num_experts"),
-        num_experts_per_tok=config.check_equal_for_all_and_get_value("mlp_blocks", "num_experts_per_tok"),
+        attention_dropout=sequence_mixer_values["softmax_dropout"],
+        num_local_experts=mlp_values["num_experts"],
+        num_experts_per_tok=mlp_values["num_experts_per_tok"],
         router_aux_loss_coef=config.router_aux_loss_coef,
         bos_token_id=config.bos_token_id,
         eos_token_id=config.eos_token_id,
         pad_token_id=config.pad_token_id,
-        embedding_multiplier=1 if config.m_emb is None else config.m_emb,
-        residual_multiplier=1 if config.m_residual is None else config.m_residual,
-        logits_scaling=1 if config.m_width is None else config.m_width,
-        attention_multiplier=config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "attention_multiplier"),
+        embedding_multiplier=1 if m_emb is None else m_emb,
+        residual_multiplier=1 if m_residual is None else m_residual,
+        logits_scaling=1 if m_width is None else m_width,
+        attention_multiplier=sequence_mixer_values["attention_multiplier"],
         architectures=[GraniteMoeForCausalLM.__name__],
     )
 
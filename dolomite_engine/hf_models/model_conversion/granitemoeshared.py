@@ -1,3 +1,5 @@
+import math
+
 import torch
 from transformers import (
     AutoConfig,
@@ -7,15 +9,42 @@ from transformers import (
     GraniteMoeSharedForCausalLM,
 )
 
-from ...utils import SafeTensorsWeightsManager, download_repo
-from ..modeling_utils import (
-    get_attention_head_type,
-    interleave_query_key_value_tensor_for_attention,
-    split_query_key_value_tensor_for_attention,
-)
+from ...utils import SafeTensorsWeightsManager, SafeTensorsWeightsWriter, download_repo
+from ..modeling_utils import get_attention_head_type, interleave_query_key_value_tensor_for_attention
 from ..models import GPTDolomiteConfig
 
 
+# (source, target, allow_cast) for the layer tensors that are exported as they are, norms and the router are
+# precision sensitive and tiny so they always keep the source dtype
+_EXPORT_LAYER_TENSOR_NAMES = [
+    ("transformer.h.{layer_idx}.ln_1.weight", "model.layers.{layer_idx}.input_layernorm.weight", False),
+    ("transformer.h.{layer_idx}.ln_2.weight", "model.layers.{layer_idx}.post_attention_layernorm.weight", False),
+    (
+        "transformer.h.{layer_idx}.mlp_block.gate.weight",
+        "model.layers.{layer_idx}.block_sparse_moe.router.layer.weight",
+        False,
+    ),
+    (
+        "transformer.h.{layer_idx}.mlp_block.c_proj.weight",
+        "model.layers.{layer_idx}.block_sparse_moe.output_linear.weight",
+        True,
+    ),
+    (
+        "transformer.h.{layer_idx}.sequence_mixer.c_proj.weight",
+        "model.layers.{layer_idx}.self_attn.o_proj.weight",
+        True,
+    ),
+]
+
+_EXPORT_SHARED_MLP_TENSOR_NAMES = [
+    (
+        "transformer.h.{layer_idx}.mlp_block.c_proj_shared.weight",
+        "model.layers.{layer_idx}.shared_mlp.output_linear.weight",
+        True,
+    )
+]
+
+
 def import_from_huggingface_granitemoeshared(pretrained_model_name_or_path: str, save_path: str) -> None:
     original_config, tokenizer, downloaded_model_path = download_repo(pretrained_model_name_or_path)
     config = _import_config_from_huggingface(original_config)
@@ -158,21 +187,29 @@ def _import_state_dict_from_huggingface(
     return state_dict
 
 
-def export_to_huggingface_granitemoeshared(pretrained_model_name_or_path: str, save_path: str) -> None:
+def export_to_huggingface_granitemoeshared(
+    pretrained_model_name_or_path: str, save_path: str, dtype: torch.dtype | None = None
+) -> None:
     config: GPTDolomiteConfig = AutoConfig.from_pretrained(pretrained_model_name_or_path)
     original_config = _export_config_to_huggingface(config)
-    num_attention_heads = config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "num_attention_heads")
 
-    safetensors_weights_manager = SafeTensorsWeightsManager(pretrained_model_name_or_path)
-    state_dict = _export_state_dict_to_huggingface(
-        safetensors_weights_manager,
-        config.num_layers,
-        num_attention_heads,
-        config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "num_key_value_heads"),
-        config.hidden_size // num_attention_heads,
-    )
+    if dtype is not None:
+        original_config.torch_dtype = dtype
+
+    with (
+        SafeTensorsWeightsManager(pretrained_model_name_or_path) as safetensors_weights_manager,
+        SafeTensorsWeightsWriter(save_path) as safetensors_weights_writer,
+    ):
+        _export_state_dict_to_huggingface(
+            safetensors_weights_manager,
+            safetensors_weights_writer,
+            config.num_layers,
+            original_config.num_attention_heads,
+            original_config.num_key_value_heads,
+            config.hidden_size // original_config.num_attention_heads,
+            dtype,
+        )
 
-    SafeTensorsWeightsManager.save_state_dict(state_dict, save_path)
     original_config.save_pretrained(save_path)
 
     original_generation_config = GenerationConfig.from_model_config(original_config)
@@ -189,21 +226,33 @@ def _export_config_to_huggingface(config: GPTDolomiteConfig) -> GraniteMoeShared
     assert config.normalization_function == "rmsnorm"
     assert config.position_embedding_type == "rope"
 
-    config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "add_bias", False)
-    config.check_equal_for_all_and_get_value("mlp_blocks", "add_bias", False)
-    config.check_equal_for_all_and_get_value("mlp_blocks", "activation_function", "swiglu")
+    sequence_mixer_values = config.check_equal_for_all_and_get_values(
+        "sequence_mixer_blocks",
+        ["num_attention_heads", "num_key_value_heads", "softmax_dropout", "attention_multiplier"],
+        expected_values={"add_bias": False},
+    )
+
     config.check_equal_for_all_and_get_value("mlp_blocks", "mlp_type", "MoE")
-    shared_intermediate_size = config.check_equal_for_all_and_get_value("mlp_blocks", "shared_intermediate_size")
+    mlp_values = config.check_equal_for_all_and_get_values(
+        "mlp_blocks",
+        ["intermediate_size", "shared_intermediate_size", "num_experts", "num_experts_per_tok"],
+        expected_values={"add_bias": False, "activation_function": "swiglu"},
+    )
+    shared_intermediate_size = mlp_values["shared_intermediate_size"]
+
+    m_emb = config.m_emb
+    m_residual = config.m_residual
+    m_width = config.m_width
 
     original_config = GraniteMoeSharedConfig(
         vocab_size=config.vocab_size,
         max_position_embeddings=config.max_position_embeddings,
         hidden_size=config.hidden_size,
         num_hidden_layers=config.num_layers,
-        num_attention_heads=config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "num_attention_heads"),
+        num_attention_heads=sequence_mixer_values["num_attention_heads"],
         shared_intermediate_size=0 if shared_intermediate_size is None else shared_intermediate_size,
-        num_key_value_heads=config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "num_key_value_heads"),
-        intermediate_size=config.check_equal_for_all_and_get_value("mlp_blocks", "intermediate_size"),
+        num_key_value_heads=sequence_mixer_values["num_key_value_heads"],
+        intermediate_size=mlp_values["intermediate_size"],
         hidden_act="silu",
         rms_norm_eps=config.layer_norm_epsilon,
         use_cache=config.use_cache,
@@ -212,17 +261,17 @@ def _export_config_to_huggingface(config: GPTDolomiteConfig) -> GraniteMoeShared
         initializer_range=config.initializer_range,
         rope_theta=config.rope_theta,
         rope_scaling=config.rope_scaling,
-        attention_dropout=config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "softmax_dropout"),
-        num_local_experts=config.check_equal_for_all_and_get_value("mlp_blocks", "num_experts"),
-        num_experts_per_tok=config.check_equal_for_all_and_get_value("mlp_blocks", "num_experts_per_tok"),
+        attention_dropout=sequence_mixer_values["softmax_dropout"],
+        num_local_experts=mlp_values["num_experts"],
+        num_experts_per_tok=mlp_values["num_experts_per_tok"],
         router_aux_loss_coef=config.router_aux_loss_coef,
         bos_token_id=config.bos_token_id,
         eos_token_id=config.eos_token_id,
         pad_token_id=config.pad_token_id,
-        embedding_multiplier=1 if config.m_emb is None else config.m_emb,
-        residual_multiplier=1 if config.m_residual is None else config.m_residual,
-        logits_scaling=1 if config.m_width is None else config.m_width,
-        attention_multiplier=config.check_equal_for_all_and_get_value("sequence_mixer_blocks", "attention_multiplier"),
+        embedding_multiplier=1 if m_emb is None else m_emb,
+        residual_multiplier=1 if m_residual is None else m_residual,
+        logits_scaling=1 if m_width is None else m_width,
+        attention_multiplier=sequence_mixer_values["attention_multiplier"],
         architectures=[GraniteMoeSharedForCausalLM.__name__],
     )
 
@@ -231,68 +280,163 @@ def _export_config_to_huggingface(config: GPTDolomiteConfig) -> GraniteMoeShared
 
 def _export_state_dict_to_huggingface(
     safetensors_weights_manager: SafeTensorsWeightsManager,
+    safetensors_weights_writer: SafeTensorsWeightsWriter,
     num_layers: int,
     num_heads: int,
     num_key_value_heads: int,
     head_dim: int,
+    dtype: torch.dtype | None = None,
 ) -> None:
-    attention_head_type = get_attention_head_type(num_heads, num_key_value_heads)
+    # all layers share the same MLP config, so probing the first layer is enough
+    has_shared_mlp = safetensors_weights_manager.has_tensor("transformer.h.0.mlp_block.c_fc_shared.weight")
 
-    state_dict = {
-        "model.embed_tokens.weight": safetensors_weights_manager.get_tensor("transformer.wte.weight"),
-        "model.norm.weight": safetensors_weights_manager.get_tensor("transformer.ln_f.weight"),
-    }
+    safetensors_weights_writer.copy(
+        "model.embed_tokens.weight", safetensors_weights_manager, "transformer.wte.weight", dtype=dtype
+    )
+    safetensors_weights_writer.copy("model.norm.weight", safetensors_weights_manager, "transformer.ln_f.weight")
 
     if safetensors_weights_manager.has_tensor("lm_head.weight"):
-        state_dict["lm_head.weight"] = safetensors_weights_manager.get_tensor("lm_head.weight")
+        safetensors_weights_writer.copy("lm_head.weight", safetensors_weights_manager, "lm_head.weight", dtype=dtype)
 
     for layer_idx in range(num_layers):
-        state_dict[f"model.layers.{layer_idx}.input_layernorm.weight"] = safetensors_weights_manager.get_tensor(
-            f"transformer.h.{layer_idx}.ln_1.weight"
-        )
-        state_dict[f"model.layers.{layer_idx}.post_attention_layernorm.weight"] = (
-            safetensors_weights_manager.get_tensor(f"transformer.h.{layer_idx}.ln_2.weight")
+        _export_layer_state_dict_to_huggingface(
+            safetensors_weights_manager,
+            safetensors_weights_writer,
+            layer_idx,
+            num_heads,
+            num_key_value_heads,
+            head_dim,
+            has_shared_mlp,
+            dtype,
         )
 
-        state_dict[f"model.layers.{layer_idx}.block_sparse_moe.router.layer.weight"] = (
-            safetensors_weights_manager.get_tensor(f"transformer.h.{layer_idx}.mlp_block.gate.weight")
-        )
 
-        state_dict[f"model.layers.{layer_idx}.block_sparse_moe.input_linear.weight"] = _split_and_reorder_for_glu(
-            safetensors_weights_manager.get_tensor(f"transformer.h.{layer_idx}.mlp_block.c_fc.weight"), dim=1
-        )
-        state_dict[f"model.layers.{layer_idx}.block_sparse_moe.output_linear.weight"] = (
-            safetensors_weights_manager.get_tensor(f"transformer.h.{layer_idx}.mlp_block.c_proj.weight")
+def _export_layer_state_dict_to_huggingface(
+    safetensors_weights_manager: SafeTensorsWeightsManager,
+    safetensors_weights_writer: SafeTensorsWeightsWriter,
+    layer_idx: int,
+    num_heads: int,
+    num_key_value_heads: int,
+    head_dim: int,
+    has_shared_mlp: bool,
+    dtype: torch.dtype | None,
+) -> None:
+    tensor_names = _EXPORT_LAYER_TENSOR_NAMES
+    if has_shared_mlp:
+        tensor_names = tensor_names + _EXPORT_SHARED_MLP_TENSOR_NAMES
+
+    for source_tensor_name, tensor_name, allow_cast in tensor_names:
+        safetensors_weights_writer.copy(
+            tensor_name.format(layer_idx=layer_idx),
+            safetensors_weights_manager,
+            source_tensor_name.format(layer_idx=layer_idx),
+            dtype=dtype if allow_cast else None,
         )
 
-        if safetensors_weights_manager.has_tensor(f"transformer.h.{layer_idx}.mlp_block.c_fc_shared.weight"):
-            state_dict[f"model.layers.{layer_idx}.shared_mlp.input_linear.weight"] = _split_and_reorder_for_glu(
-                safetensors_weights_manager.get_tensor(f"transformer.h.{layer_idx}.mlp_block.c_fc_shared.weight"),
-                dim=0,
-            )
-            state_dict[f"model.layers.{layer_idx}.shared_mlp.output_linear.weight"] = (
-                safetensors_weights_manager.get_tensor(f"transformer.h.{layer_idx}.mlp_block.c_proj_shared.weight")
-            )
-
-        query_weight, key_weight, value_weight = split_query_key_value_tensor_for_attention(
-            safetensors_weights_manager.get_tensor(f"transformer.h.{layer_idx}.sequence_mixer.c_attn.weight"),
-            num_heads,
-            num_key_value_heads,
-            head_dim,
-            attention_head_type,
-        )
-        state_dict[f"model.layers.{layer_idx}.self_attn.q_proj.weight"] = query_weight
-        state_dict[f"model.layers.{layer_idx}.self_attn.k_proj.weight"] = key_weight
-        state_dict[f"model.layers.{layer_idx}.self_attn.v_proj.weight"] = value_weight
+    _copy_and_reorder_for_glu(
+        safetensors_weights_manager,
+        safetensors_weights_writer,
+        f"model.layers.{layer_idx}.block_sparse_moe.input_linear.weight",
+        f"transformer.h.{layer_idx}.mlp_block.c_fc.weight",
+        dim=1,
+        dtype=dtype,
+    )
 
-        state_dict[f"model.layers.{layer_idx}.self_attn.o_proj.weight"] = safetensors_weights_manager.get_tensor(
-            f"transformer.h.{layer_idx}.sequence_mixer.c_proj.weight"
+    if has_shared_mlp:
+        _copy_and_reorder_for_glu(
+            safetensors_weights_manager,
+            safetensors_weights_writer,
+            f"model.layers.{layer_idx}.shared_mlp.input_linear.weight",
+            f"transformer.h.{layer_idx}.mlp_block.c_fc_shared.weight",
+            dim=0,
+            dtype=dtype,
         )
 
-    return state_dict
+    _copy_and_split_query_key_value(
+        safetensors_weights_manager,
+        safetensors_weights_writer,
+        [
+            f"model.layers.{layer_idx}.self_attn.q_proj.weight",
+            f"model.layers.{layer_idx}.self_attn.k_proj.weight",
+            f"model.layers.{layer_idx}.self_attn.v_proj.weight",
+        ],
+        f"transformer.h.{layer_idx}.sequence_mixer.c_attn.weight",
+        num_heads,
+        num_key_value_heads,
+        head_dim,
+        dtype,
+    )
 
 
 def _split_and_reorder_for_glu(weight: torch.Tensor, dim: int) -> torch.Tensor:
-    x, y = weight.chunk(2, dim=dim)
-    weight = torch.cat([y, x], dim=dim)
-    return weight
+    # one output allocation, each half is copied straight into its swapped position
+    half_size = weight.size(dim) // 2
+    output = torch.empty_like(weight, memory_format=torch.contiguous_format)
+
+    output.narrow(dim, 0, half_size).copy_(weight.narrow(dim, half_size, half_size))
+    output.narrow(dim, half_size, half_size).copy_(weight.narrow(dim, 0, half_size))
+
+    return output
+
+
+def _copy_and_reorder_for_glu(
+    safetensors_weights_manager: SafeTensorsWeightsManager,
+    safetensors_weights_writer: SafeTensorsWeightsWriter,
+    tensor_name: str,
+    source_tensor_name: str,
+    dim: int,
+    dtype: torch.dtype | None = None,
+) -> None:
+    # for every index of the dims before dim, the two halves along dim are contiguous blocks of bytes, so
+    # _split_and_reorder_for_glu is a file to file copy of these blocks in swapped order
+    num_blocks = math.prod(safetensors_weights_manager.get_shape(source_tensor_name)[:dim])
+    _, _, nbytes = safetensors_weights_manager.get_file_range(source_tensor_name)
+    half_block_nbytes = nbytes // (2 * num_blocks)
+
+    byte_ranges = []
+    for block_idx in range(num_blocks):
+        block_start = 2 * block_idx * half_block_nbytes
+        byte_ranges.append((block_start + half_block_nbytes, half_block_nbytes))
+        byte_ranges.append((block_start, half_block_nbytes))
+
+    safetensors_weights_writer.copy(
+        tensor_name, safetensors_weights_manager, source_tensor_name, byte_ranges=byte_ranges, dtype=dtype
+    )
+
+
+def _copy_and_split_query_key_value(
+    safetensors_weights_manager: SafeTensorsWeightsManager,
+    safetensors_weights_writer: SafeTensorsWeightsWriter,
+    tensor_names: list[str],
+    source_tensor_name: str,
+    num_heads: int,
+    num_key_value_heads: int,
+    head_dim: int,
+    dtype: torch.dtype | None,
+) -> None:
+    # c_attn is num_key_value_heads groups of (query heads of the group, key head, value head) along dim 0, this also
+    # holds for mha (1 query head per group) and mqa (1 group). so each of q, k and v is a file to file copy of one
+    # contiguous block of bytes per group
+    shape = safetensors_weights_manager.get_shape(source_tensor_name)
+    _, _, nbytes = safetensors_weights_manager.get_file_range(source_tensor_name)
+
+    query_heads_per_group = num_heads // num_key_value_heads
+    head_nbytes = head_dim * nbytes // shape[0]
+    group_nbytes = (query_heads_per_group + 2) * head_nbytes
+
+    for tensor_name, start, heads_per_group in zip(
+        tensor_names,
+        [0, query_heads_per_group * head_nbytes, (query_heads_per_group + 1) * head_nbytes],
+        [query_heads_per_group, 1, 1],
+    ):
+        safetensors_weights_writer.copy(
+            tensor_name,
+            safetensors_weights_manager,
+            source_tensor_name,
+            byte_ranges=[
+                (group_idx * group_nbytes + start, heads_per_group * head_nbytes)
+                for group_idx in range(num_key_value_heads)
+            ],
+            shape=[num_key_value_heads * heads_per_group * head_dim, *shape[1:]],
+            dtype=dtype,
+        )
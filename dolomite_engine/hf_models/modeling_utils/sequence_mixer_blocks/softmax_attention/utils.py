@@ -8,16 +8,16 @@ def interleave_query_key_value_tensor_for_mha(
     num_heads: int,
     head_dim: int,
 ) -> torch.Tensor:
-    interleaved = []
-    for i in range(num_heads):
-        start_index = i * head_dim
-        end_index = start_index + head_dim
+    # [:] for converting slice to tensor
+    query_weight = query_weight[:]
+    original_shape = query_weight.shape
 
-        interleaved.append(query_weight[start_index:end_index])
-        interleaved.append(key_weight[start_index:end_index])
-        interleaved.append(value_weight[start_index:end_index])
+    query_weight = query_weight.reshape(num_heads, head_dim, *original_shape[1:])
+    key_weight = key_weight[:].reshape(num_heads, head_dim, *original_shape[1:])
+    value_weight = value_weight[:].reshape(num_heads, head_dim, *original_shape[1:])
 
-    return torch.cat(interleaved)
+    query_key_value_weight = torch.cat([query_weight, key_weight, value_weight], dim=1)
+    return query_key_value_weight.view(-1, *original_shape[1:])
 
 
 def split_query_key_value_tensor_for_mha(
@@ -46,18 +46,16 @@ def interleave_query_key_value_tensor_for_gqa(
 ) -> torch.Tensor:
     query_heads_per_group = num_heads // num_key_value_heads
 
-    interleaved = []
-    for i in range(num_key_value_heads):
-        start_index = i * query_heads_per_group * head_dim
-        end_index = start_index + query_heads_per_group * head_dim
-        interleaved.append(query_weight[start_index:end_index])
+    # [:] for converting slice to tensor
+    query_weight = query_weight[:]
+    original_shape = query_weight.shape
 
-        start_index = i * head_dim
-        end_index = start_index + head_dim
-        interleaved.append(key_weight[start_index:end_index])
-        interleaved.append(value_weight[start_index:end_index])
+    query_weight = query_weight.reshape(num_key_value_heads, query_heads_per_group * head_dim, *original_shape[1:])
+    key_weight = key_weight[:].reshape(num_key_value_heads, head_dim, *original_shape[1:])
+    value_weight = value_weight[:].reshape(num_key_value_heads, head_dim, *original_shape[1:])
 
-    return torch.cat(interleaved)
+    query_key_value_weight = torch.cat([query_weight, key_weight, value_weight], dim=1)
+    return query_key_value_weight.view(-1, *original_shape[1:])
 
 
 def split_query_key_value_tensor_for_gqa(
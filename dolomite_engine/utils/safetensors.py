@@ -1,11 +1,35 @@
+import errno
 import json
 import os
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from huggingface_hub import split_torch_state_dict_into_shards
 from safetensors import safe_open
 from safetensors.torch import save_file
-from transformers.modeling_utils import SAFE_WEIGHTS_INDEX_NAME
+from transformers.modeling_utils import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME
+
+
+_TORCH_TO_SAFETENSORS_DTYPES = {
+    torch.bool: "BOOL",
+    torch.uint8: "U8",
+    torch.int8: "I8",
+    torch.int16: "I16",
+    torch.int32: "I32",
+    torch.int64: "I64",
+    torch.float8_e4m3fn: "F8_E4M3",
+    torch.float8_e5m2: "F8_E5M2",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.float32: "F32",
+    torch.float64: "F64",
+}
+
+_SAFETENSORS_TO_TORCH_DTYPES = {value: key for key, value in _TORCH_TO_SAFETENSORS_DTYPES.items()}
+
+_COPY_CHUNK_SIZE = 64 * 1024 * 1024
 
 
 class SafeTensorsWeightsManager:
@@ -18,7 +42,9 @@ class SafeTensorsWeightsManager:
             filenames = [os.path.join(model_path, filename) for filename in filenames]
 
         self.tensor_filenames = {}
+        self.tensor_metadata = {}
         self.file_handles = {}
+        self.raw_file_handles = {}
 
         for filename in filenames:
             f = safe_open(filename, framework="pytorch")
@@ -27,6 +53,16 @@ class SafeTensorsWeightsManager:
             for tensor_name in f.keys():
                 self.tensor_filenames[tensor_name] = filename
 
+            header, data_offset = _read_safetensors_header(filename)
+            for tensor_name, metadata in header.items():
+                start, end = metadata["data_offsets"]
+                self.tensor_metadata[tensor_name] = {
+                    "dtype": metadata["dtype"],
+                    "shape": metadata["shape"],
+                    "offset": data_offset + start,
+                    "nbytes": end - start,
+                }
+
     def get_slice(self, tensor_name: str):
         filename = self.tensor_filenames[tensor_name]
         f = self.file_handles[filename]
@@ -41,9 +77,20 @@ class SafeTensorsWeightsManager:
         tensor = tensor.to(dtype=dtype, device=device)
         return tensor
 
-    def get_shape(self, tensor_name: str) -> torch.Tensor:
-        slice = self.get_slice(tensor_name)
-        return slice.get_shape()
+    def get_file_range(self, tensor_name: str) -> tuple[int, int, int]:
+        filename = self.tensor_filenames[tensor_name]
+        # raw handles are only needed for byte range copies, they are opened on first use and closed by close
+        if filename not in self.raw_file_handles:
+            self.raw_file_handles[filename] = open(filename, "rb")
+
+        metadata = self.tensor_metadata[tensor_name]
+        return self.raw_file_handles[filename].fileno(), metadata["offset"], metadata["nbytes"]
+
+    def get_shape(self, tensor_name: str) -> list[int]:
+        return list(self.tensor_metadata[tensor_name]["shape"])
+
+    def get_dtype(self, tensor_name: str) -> torch.dtype:
+        return _SAFETENSORS_TO_TORCH_DTYPES[self.tensor_metadata[tensor_name]["dtype"]]
 
     def has_tensor(self, tensor_name: str) -> bool:
         return tensor_name in self.tensor_filenames
@@ -74,6 +121,18 @@ class SafeTensorsWeightsManager:
     def state_dict(self) -> dict:
         return {tensor_name: self.get_tensor(tensor_name) for tensor_name in self}
 
+    def close(self) -> None:
+        for f in self.raw_file_handles.values():
+            f.close()
+
+        self.raw_file_handles = {}
+
+    def __enter__(self) -> "SafeTensorsWeightsManager":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
     @staticmethod
     def save_state_dict(state_dict: dict, save_path: str) -> None:
         os.makedirs(save_path, exist_ok=True)
@@ -95,3 +154,306 @@ class SafeTensorsWeightsManager:
 
             with open(os.path.join(save_path, SAFE_WEIGHTS_INDEX_NAME), "w") as f:
                 f.write(json.dumps(index, indent=2))
+
+
+class SafeTensorsWeightsWriter:
+    def __init__(
+        self, save_path: str, max_shard_size: int = 5 * 10**9, max_workers: int = 32, max_pending_shards: int = 4
+    ) -> None:
+        os.makedirs(save_path, exist_ok=True)
+
+        self.save_path = save_path
+        self.max_shard_size = max_shard_size
+        self.max_pending_shards = max_pending_shards
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending_shards = deque()
+
+        self.shard = []
+        self.shard_size = 0
+        self.shard_filenames = []
+        self.weight_map = {}
+        self.total_size = 0
+
+    def write(self, tensor_name: str, tensor: torch.Tensor) -> None:
+        self._add(
+            tensor_name,
+            _TORCH_TO_SAFETENSORS_DTYPES[tensor.dtype],
+            list(tensor.shape),
+            tensor.numel() * tensor.element_size(),
+            tensor,
+        )
+
+    def copy(
+        self,
+        tensor_name: str,
+        safetensors_weights_manager: SafeTensorsWeightsManager,
+        source_tensor_name: str,
+        byte_ranges: list[tuple[int, int]] | None = None,
+        shape: list[int] | None = None,
+        dtype: torch.dtype | None = None,
+    ) -> None:
+        metadata = safetensors_weights_manager.tensor_metadata[source_tensor_name]
+        fd, offset, nbytes = safetensors_weights_manager.get_file_range(source_tensor_name)
+
+        # byte_ranges are (start, nbytes) pairs relative to the source tensor, concatenated in the given order. shape
+        # needs to be passed when the ranges don't cover the full source tensor
+        if byte_ranges is None:
+            byte_ranges = [(0, nbytes)]
+
+        if shape is None:
+            shape = list(metadata["shape"])
+
+        nbytes = sum([range_nbytes for _, range_nbytes in byte_ranges])
+        byte_ranges = [(fd, offset + start, range_nbytes) for start, range_nbytes in byte_ranges]
+
+        if dtype is None or _TORCH_TO_SAFETENSORS_DTYPES[dtype] == metadata["dtype"]:
+            self._add(tensor_name, metadata["dtype"], shape, nbytes, (byte_ranges, None))
+            return
+
+        # the cast is done by the worker that writes the tensor, so nothing is held by the shard until the flush
+        source_dtype = _SAFETENSORS_TO_TORCH_DTYPES[metadata["dtype"]]
+        self._add(
+            tensor_name,
+            _TORCH_TO_SAFETENSORS_DTYPES[dtype],
+            shape,
+            nbytes // source_dtype.itemsize * dtype.itemsize,
+            (byte_ranges, (source_dtype, dtype)),
+        )
+
+    def close(self) -> None:
+        try:
+            if len(self.shard) > 0 or len(self.shard_filenames) == 0:
+                self._flush()
+
+            while len(self.pending_shards) > 0:
+                self._wait_for_shard()
+        except BaseException:
+            self._abort()
+            raise
+        finally:
+            self.executor.shutdown()
+
+        num_shards = len(self.shard_filenames)
+
+        if num_shards == 1:
+            os.replace(self.shard_filenames[0], os.path.join(self.save_path, SAFE_WEIGHTS_NAME))
+            return
+
+        shard_index_to_filename = {}
+        for shard_index, shard_filename in enumerate(self.shard_filenames):
+            filename = f"model-{shard_index + 1:05d}-of-{num_shards:05d}.safetensors"
+            os.replace(shard_filename, os.path.join(self.save_path, filename))
+            shard_index_to_filename[shard_index] = filename
+
+        index = {
+            "metadata": {"total_size": self.total_size},
+            "weight_map": {
+                tensor_name: shard_index_to_filename[shard_index]
+                for tensor_name, shard_index in self.weight_map.items()
+            },
+        }
+
+        with open(os.path.join(self.save_path, SAFE_WEIGHTS_INDEX_NAME), "w") as f:
+            f.write(json.dumps(index, indent=2))
+
+    def _add(
+        self,
+        tensor_name: str,
+        dtype: str,
+        shape: list[int],
+        nbytes: int,
+        source: torch.Tensor | tuple[list[tuple[int, int, int]], tuple[torch.dtype, torch.dtype] | None],
+    ) -> None:
+        if len(self.shard) > 0 and self.shard_size + nbytes > self.max_shard_size:
+            self._flush()
+
+        self.shard.append((tensor_name, dtype, shape, nbytes, source))
+        self.shard_size += nbytes
+        self.total_size += nbytes
+
+    def _flush(self) -> None:
+        header = {"__metadata__": {"format": "pt"}}
+        offsets = []
+
+        start = 0
+        for tensor_name, dtype, shape, nbytes, _ in self.shard:
+            header[tensor_name] = {"dtype": dtype, "shape": shape, "data_offsets": [start, start + nbytes]}
+            offsets.append(start)
+            start += nbytes
+
+        header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        # safetensors expects the data section to be 8 byte aligned, the header is padded with spaces
+        header += b" " * (-len(header) % 8)
+        data_offset = 8 + len(header)
+
+        # shards are written under a temporary name since the total number of shards is only known on close. the
+        # shard is registered before anything is written so that _abort can clean it up
+        shard_index = len(self.shard_filenames)
+        shard_filename = os.path.join(self.save_path, f"model-{shard_index + 1:05d}.safetensors.tmp")
+        self.shard_filenames.append(shard_filename)
+
+        f = open(shard_filename, "wb")
+        futures = []
+        self.pending_shards.append((f, futures))
+
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.flush()
+        f.truncate(data_offset + start)
+
+        # ask the kernel to start reading all the source ranges of this shard, so that disk reads overlap with the
+        # copies instead of each copy faulting its pages in on demand
+        for _, _, _, _, source in self.shard:
+            if not isinstance(source, torch.Tensor):
+                for source_fd, source_offset, nbytes in source[0]:
+                    _prefetch(source_fd, source_offset, nbytes)
+
+        # every tensor has a known offset in the file now, so they are written independently of each other and of
+        # the other shards. the shard is written in the background while the next ones are filled, only
+        # max_pending_shards are kept in flight to bound the memory held by their sources
+        for offset, (_, _, _, _, source) in zip(offsets, self.shard):
+            futures.append(self.executor.submit(_write_tensor, f.fileno(), data_offset + offset, source))
+
+        for tensor_name, _, _, _, _ in self.shard:
+            self.weight_map[tensor_name] = shard_index
+
+        self.shard = []
+        self.shard_size = 0
+
+        if len(self.pending_shards) > self.max_pending_shards:
+            self._wait_for_shard()
+
+    def _wait_for_shard(self) -> None:
+        f, futures = self.pending_shards.popleft()
+
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            f.close()
+
+    def _abort(self) -> None:
+        # waits for the writes that are already running, so no worker touches the files after they are removed
+        self.executor.shutdown(cancel_futures=True)
+
+        while len(self.pending_shards) > 0:
+            f, _ = self.pending_shards.popleft()
+            f.close()
+
+        for shard_filename in self.shard_filenames:
+            if os.path.exists(shard_filename):
+                os.remove(shard_filename)
+
+    def __enter__(self) -> "SafeTensorsWeightsWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+
+def _write_tensor(
+    fd: int,
+    offset: int,
+    source: torch.Tensor | tuple[list[tuple[int, int, int]], tuple[torch.dtype, torch.dtype] | None],
+) -> None:
+    if isinstance(source, torch.Tensor):
+        _pwrite(fd, source.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy(), offset)
+        return
+
+    byte_ranges, cast = source
+    if cast is None:
+        for source_fd, source_offset, nbytes in byte_ranges:
+            _copy_file_range(source_fd, source_offset, fd, offset, nbytes)
+            offset += nbytes
+    else:
+        _cast_file_range(byte_ranges, *cast, fd, offset)
+
+
+def _cast_file_range(
+    byte_ranges: list[tuple[int, int, int]], source_dtype: torch.dtype, dtype: torch.dtype, fd: int, offset: int
+) -> None:
+    # casting is elementwise, so the ranges are cast one chunk at a time straight into the output and a worker never
+    # holds more than one chunk of the source and its cast
+    chunk_size = _COPY_CHUNK_SIZE - _COPY_CHUNK_SIZE % source_dtype.itemsize
+    buffer = torch.empty(min(chunk_size, max([nbytes for _, _, nbytes in byte_ranges])), dtype=torch.uint8)
+
+    for source_fd, source_offset, nbytes in byte_ranges:
+        while nbytes > 0:
+            chunk = buffer[: min(nbytes, buffer.numel())]
+            _pread(source_fd, chunk.numpy(), source_offset)
+
+            cast_chunk = chunk.view(source_dtype).to(dtype)
+            _pwrite(fd, cast_chunk.view(torch.uint8).numpy(), offset)
+
+            source_offset += chunk.numel()
+            nbytes -= chunk.numel()
+            offset += cast_chunk.numel() * dtype.itemsize
+
+
+def _prefetch(fd: int, offset: int, nbytes: int) -> None:
+    # posix_fadvise treats a length of 0 as up to the end of the file
+    if nbytes > 0 and hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, nbytes, os.POSIX_FADV_WILLNEED)
+
+
+def _pread(fd: int, buffer, offset: int) -> None:
+    buffer = memoryview(buffer)
+
+    while len(buffer) > 0:
+        num_bytes_read = os.preadv(fd, [buffer], offset)
+        if num_bytes_read == 0:
+            raise EOFError(f"unexpected end of file while reading {len(buffer)} bytes at offset {offset}")
+
+        buffer = buffer[num_bytes_read:]
+        offset += num_bytes_read
+
+
+def _pwrite(fd: int, buffer, offset: int) -> None:
+    buffer = memoryview(buffer)
+
+    while len(buffer) > 0:
+        num_bytes_written = os.pwrite(fd, buffer, offset)
+        buffer = buffer[num_bytes_written:]
+        offset += num_bytes_written
+
+
+def _copy_file_range(source_fd: int, source_offset: int, fd: int, offset: int, nbytes: int) -> None:
+    # copy_file_range keeps the copy inside the kernel, fall back to pread + pwrite where it is unavailable
+    if hasattr(os, "copy_file_range"):
+        try:
+            while nbytes > 0:
+                num_bytes_copied = os.copy_file_range(source_fd, fd, nbytes, source_offset, offset)
+                if num_bytes_copied == 0:
+                    raise EOFError(f"unexpected end of file while copying {nbytes} bytes at offset {source_offset}")
+
+                source_offset += num_bytes_copied
+                offset += num_bytes_copied
+                nbytes -= num_bytes_copied
+
+            return
+        except OSError as error:
+            if error.errno not in [errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL]:
+                raise
+
+    while nbytes > 0:
+        buffer = os.pread(source_fd, min(nbytes, _COPY_CHUNK_SIZE), source_offset)
+        if len(buffer) == 0:
+            raise EOFError(f"unexpected end of file while copying {nbytes} bytes at offset {source_offset}")
+
+        _pwrite(fd, buffer, offset)
+
+        source_offset += len(buffer)
+        offset += len(buffer)
+        nbytes -= len(buffer)
+
+
+def _read_safetensors_header(filename: str) -> tuple[dict, int]:
+    with open(filename, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+
+    header.pop("__metadata__", None)
+    return header, 8 + header_size
@@ -1,6 +1,18 @@
+import os
+import tempfile
+
 import torch
 from parameterized import parameterized
 
+from dolomite_engine import SafeTensorsWeightsManager
+from dolomite_engine.hf_models import export_to_huggingface, import_from_huggingface
+from dolomite_engine.hf_models.model_conversion.granitemoe import (
+    _export_config_to_huggingface as _export_config_to_huggingface_granitemoe,
+)
+from dolomite_engine.hf_models.model_conversion.granitemoeshared import (
+    _export_config_to_huggingface as _export_config_to_huggingface_granitemoeshared,
+)
+
 from ..test_common import TestCommons
 
 
@@ -95,3 +107,59 @@ class ModelConversionTest(TestCommons):
             exact_match=False,
             compare_loss=False,
         )
+
+    @parameterized.expand(TestCommons.make_args_matrix(["granitemoe", "granitemoeshared"]))
+    def test_moe_model_conversion_with_dtype(self, model_type: str) -> None:
+        dolomite_config = self.get_moe_test_config(
+            "gqa",
+            "rope",
+            add_bias=False,
+            shared_n_inner=64 if model_type == "granitemoeshared" else None,
+            activation_function="swiglu",
+            normalization_function="rmsnorm",
+        )
+        dolomite_model = self.from_config(dolomite_config)
+
+        with tempfile.TemporaryDirectory() as tmp_path:
+            save_path = os.path.join(tmp_path, "save")
+            export_path = os.path.join(tmp_path, "export")
+            import_path = os.path.join(tmp_path, "import")
+
+            dolomite_model.save_pretrained(save_path, safe_serialization=True)
+
+            export_to_huggingface(save_path, export_path, model_type=model_type, dtype=torch.bfloat16)
+            import_from_huggingface(export_path, import_path)
+
+            with (
+                SafeTensorsWeightsManager(save_path) as original_weights,
+                SafeTensorsWeightsManager(import_path) as imported_weights,
+            ):
+                assert len(original_weights) == len(imported_weights)
+
+                for tensor_name in original_weights:
+                    tensor = original_weights.get_tensor(tensor_name)
+
+                    if tensor_name.endswith(("ln_1.weight", "ln_2.weight", "ln_f.weight", "gate.weight")):
+                        assert imported_weights.get_tensor(tensor_name).equal(tensor)
+                    else:
+                        assert imported_weights.get_tensor(tensor_name).equal(tensor.to(torch.bfloat16))
+
+    def test_model_conversion_with_dtype_unsupported(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_path:
+            with self.assertRaises(NotImplementedError):
+                export_to_huggingface(
+                    tmp_path, os.path.join(tmp_path, "export"), model_type="llama", dtype=torch.bfloat16
+                )
+
+    @parameterized.expand(
+        TestCommons.make_args_matrix(
+            [_export_config_to_huggingface_granitemoe, _export_config_to_huggingface_granitemoeshared]
+        )
+    )
+    def test_moe_export_rejects_dense_config(self, export_config_to_huggingface) -> None:
+        dolomite_config = self.get_dense_test_config(
+            "gqa", "rope", add_bias=False, activation_function="swiglu", normalization_function="rmsnorm"
+        )
+
+        with self.assertRaises(AssertionError):
+            export_config_to_huggingface(dolomite_config)
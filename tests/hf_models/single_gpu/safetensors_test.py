@@ -0,0 +1,116 @@
+import json
+import os
+import tempfile
+
+import torch
+from parameterized import parameterized
+from transformers.modeling_utils import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME
+
+from dolomite_engine.utils import SafeTensorsWeightsManager, SafeTensorsWeightsWriter
+
+from ..test_common import TestCommons
+
+
+class SafeTensorsTest(TestCommons):
+    @parameterized.expand(TestCommons.make_args_matrix([1000, 10**9]))
+    def test_safetensors_weights_writer(self, max_shard_size: int) -> None:
+        state_dict = {f"tensor_{i}": torch.randn(20, 10) for i in range(8)}
+
+        with tempfile.TemporaryDirectory() as tmp_path:
+            with SafeTensorsWeightsWriter(tmp_path, max_shard_size=max_shard_size) as safetensors_weights_writer:
+                for tensor_name, tensor in state_dict.items():
+                    safetensors_weights_writer.write(tensor_name, tensor)
+
+            if max_shard_size == 1000:
+                with open(os.path.join(tmp_path, SAFE_WEIGHTS_INDEX_NAME), "r") as f:
+                    index = json.load(f)
+
+                assert set(index["weight_map"].keys()) == set(state_dict.keys())
+                assert len(set(index["weight_map"].values())) == len(state_dict)
+            else:
+                assert os.listdir(tmp_path) == [SAFE_WEIGHTS_NAME]
+
+            safetensors_weights_manager = SafeTensorsWeightsManager(tmp_path)
+            assert len(safetensors_weights_manager) == len(state_dict)
+
+            for tensor_name, tensor in state_dict.items():
+                assert safetensors_weights_manager.get_tensor(tensor_name).equal(tensor)
+
+    def test_safetensors_weights_writer_copy(self) -> None:
+        state_dict = {"weight": torch.randn(20, 10, dtype=torch.bfloat16), "index": torch.arange(16)}
+
+        with tempfile.TemporaryDirectory() as tmp_path:
+            source_path = os.path.join(tmp_path, "source")
+            save_path = os.path.join(tmp_path, "save")
+
+            SafeTensorsWeightsManager.save_state_dict(state_dict, source_path)
+            with (
+                SafeTensorsWeightsManager(source_path) as source_safetensors_weights_manager,
+                SafeTensorsWeightsWriter(save_path) as safetensors_weights_writer,
+            ):
+                safetensors_weights_writer.copy("copied_weight", source_safetensors_weights_manager, "weight")
+                safetensors_weights_writer.write("written_index", state_dict["index"])
+                safetensors_weights_writer.copy("copied_index", source_safetensors_weights_manager, "index")
+                safetensors_weights_writer.copy(
+                    "copied_rows",
+                    source_safetensors_weights_manager,
+                    "weight",
+                    byte_ranges=[(160, 40), (0, 40)],
+                    shape=[4, 10],
+                )
+                safetensors_weights_writer.copy(
+                    "cast_weight", source_safetensors_weights_manager, "weight", dtype=torch.float32
+                )
+                safetensors_weights_writer.copy(
+                    "cast_rows",
+                    source_safetensors_weights_manager,
+                    "weight",
+                    byte_ranges=[(160, 40), (0, 40)],
+                    shape=[4, 10],
+                    dtype=torch.float32,
+                )
+
+            safetensors_weights_manager = SafeTensorsWeightsManager(save_path)
+
+            assert safetensors_weights_manager.get_tensor("copied_weight").equal(state_dict["weight"])
+            assert safetensors_weights_manager.get_tensor("written_index").equal(state_dict["index"])
+            assert safetensors_weights_manager.get_tensor("copied_index").equal(state_dict["index"])
+            assert safetensors_weights_manager.get_tensor("copied_rows").equal(
+                torch.cat([state_dict["weight"][8:10], state_dict["weight"][:2]])
+            )
+            assert safetensors_weights_manager.get_tensor("cast_weight").equal(state_dict["weight"].float())
+            assert safetensors_weights_manager.get_tensor("cast_rows").equal(
+                torch.cat([state_dict["weight"][8:10], state_dict["weight"][:2]]).float()
+            )
+
+    @parameterized.expand(TestCommons.make_args_matrix([1000, 10**9], [None, torch.float64]))
+    def test_safetensors_weights_writer_cleanup_on_failure(
+        self, max_shard_size: int, dtype: torch.dtype | None
+    ) -> None:
+        state_dict = {f"tensor_{i}": torch.randn(20, 10) for i in range(8)}
+
+        with tempfile.TemporaryDirectory() as tmp_path:
+            source_path = os.path.join(tmp_path, "source")
+            save_path = os.path.join(tmp_path, "save")
+
+            SafeTensorsWeightsManager.save_state_dict(state_dict, source_path)
+
+            with SafeTensorsWeightsManager(source_path) as source_safetensors_weights_manager:
+                # cut the file after the first tensor so that the other copies run into the end of the file, with small
+                # shards this fails while copying and with a single shard it fails in close
+                metadata = source_safetensors_weights_manager.tensor_metadata["tensor_0"]
+                os.truncate(os.path.join(source_path, SAFE_WEIGHTS_NAME), metadata["offset"] + metadata["nbytes"])
+
+                safetensors_weights_writer = SafeTensorsWeightsWriter(save_path, max_shard_size=max_shard_size)
+
+                with self.assertRaises(EOFError):
+                    with safetensors_weights_writer:
+                        for tensor_name in state_dict:
+                            safetensors_weights_writer.copy(
+                                tensor_name, source_safetensors_weights_manager, tensor_name, dtype=dtype
+                            )
+
+            assert os.listdir(save_path) == []
+
+            with self.assertRaises(RuntimeError):
+                safetensors_weights_writer.executor.submit(print)
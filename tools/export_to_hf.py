@@ -6,3 +6,6 @@ save_path = "save/"
 
 # export to HF llama
 export_to_huggingface(load_path, save_path, model_type="llama")
+
+# MoE models can also be cast to a different dtype on export
+# export_to_huggingface(load_path, save_path, model_type="granitemoe", dtype=torch.bfloat16)